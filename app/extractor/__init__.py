@@ -1,5 +1,22 @@
-from .pdf_parser import PDFParser
-from .gemini_extractor import MetricsExtractor
-from .utils import clean_text, format_metrics
+from .rate_limiter import TokenBucket
+from .utils import clean_text, format_metrics, extract_json, find_json_span, save_metrics, save_metrics_async
 
-__all__ = ['PDFParser', 'MetricsExtractor', 'clean_text', 'format_metrics']
\ No newline at end of file
+# PDFParser and MetricsExtractor pull in PyPDF2/langchain and google-genai,
+# so they are only imported the first time they are accessed.
+_LAZY = {
+    'PDFParser': '.pdf_parser',
+    'MetricsExtractor': '.gemini_extractor',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        from importlib import import_module
+        value = getattr(import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ['PDFParser', 'MetricsExtractor', 'TokenBucket', 'clean_text', 'format_metrics', 'extract_json', 'find_json_span',
+           'save_metrics', 'save_metrics_async']
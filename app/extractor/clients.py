@@ -0,0 +1,9 @@
+import streamlit as st
+
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client(api_key: str):
+    """Return one genai.Client per API key, shared across Streamlit reruns and sessions."""
+    from google import genai
+
+    return genai.Client(api_key=api_key)
@@ -1,19 +1,45 @@
 import streamlit as st
 import pandas as pd
-import os, json, re
+import os
+import orjson
 from pathlib import Path
-from google import genai
+
+from .utils import extract_json, to_esg_category, save_metrics_async
+
+DISPLAY_COLUMNS = ["metric_name", "value", "unit", "year", "source"]
+EXPECTED_COLUMNS = ["metric_name", "value", "unit", "year", "category", "source"]
 
 
 # ------------------------------------------------------------
-# Helper to extract JSON safely from Gemini output
+# Load an extracted CSV split by category (cached per file version)
 # ------------------------------------------------------------
-def extract_json(text: str):
-    """Extract JSON from Gemini output, even if wrapped in code fences."""
-    json_match = re.search(r"```(?:json)?\s*(\[[\s\S]*\])\s*```", text, re.DOTALL)
-    if json_match:
-        text = json_match.group(1)
-    return text.strip()
+@st.cache_data(show_spinner=False)
+def _split_by_category(path: str, mtime: float):
+    """Return {category: rows} for path, or None if expected columns are missing.
+
+    mtime is only part of the cache key, so an edited CSV is re-read.
+    Switching categories is then a dict lookup rather than a new filter.
+    """
+    df = pd.read_csv(path, usecols=lambda c: c in EXPECTED_COLUMNS, dtype={"value": str})
+    if not set(EXPECTED_COLUMNS).issubset(df.columns):
+        return None
+    df["category"] = to_esg_category(df["category"])
+    return {
+        cat: group.reset_index(drop=True)
+        for cat, group in df.groupby("category", observed=True, sort=False)
+    }
+
+
+# ------------------------------------------------------------
+# Compact Gemini payload: column names once, then one JSON array per row
+# ------------------------------------------------------------
+def _tables_payload(dataframes):
+    parts = []
+    for n, df in enumerate(dataframes, start=1):
+        header = f"dataset_{n} columns: {orjson.dumps(list(df.columns)).decode()}"
+        rows = [orjson.dumps(row, option=orjson.OPT_SERIALIZE_NUMPY).decode() for row in df.values.tolist()]
+        parts.append("\n".join([header, *rows]))
+    return "\n---\n".join(parts)
 
 
 # ------------------------------------------------------------
@@ -34,33 +60,21 @@ def display_common_metrics_tables(common_metrics):
         # Find the maximum number of entries among datasets
         max_len = max(len(group[key]) for key in dataset_keys if isinstance(group[key], list))
 
-        table_data = {}
-
+        # One frame per dataset, padded to max_len rows (each dataset contributes 5 columns)
+        sub_frames = []
         for dataset_key in dataset_keys:
             entries = group.get(dataset_key, [])
-
-            metric_names = [entry.get("metric_name", "") for entry in entries]
-            values = [entry.get("value", "") for entry in entries]
-            units = [entry.get("unit", "") for entry in entries]
-            years = [entry.get("year", "") for entry in entries]
-            sources = [entry.get("source", "") for entry in entries]
-
-            # Pad to align table rows
-            metric_names += [""] * (max_len - len(metric_names))
-            values += [""] * (max_len - len(values))
-            units += [""] * (max_len - len(units))
-            years += [""] * (max_len - len(years))
-            sources += [""] * (max_len - len(sources))
-
-            # Add to table data (each dataset contributes 5 columns)
-            table_data[f"{dataset_key}_metric_name"] = metric_names
-            table_data[f"{dataset_key}_value"] = values
-            table_data[f"{dataset_key}_unit"] = units
-            table_data[f"{dataset_key}_year"] = years
-            table_data[f"{dataset_key}_source"] = sources
+            sub = (
+                # object dtype from the start so nulls or padding never turn ints into floats
+                pd.DataFrame(entries, columns=DISPLAY_COLUMNS, dtype=object)
+                .reindex(range(max_len))
+                .fillna("")
+            )
+            sub.columns = [f"{dataset_key}_{c}" for c in sub.columns]
+            sub_frames.append(sub)
 
         # Create DataFrame for this common metric
-        df = pd.DataFrame(table_data)
+        df = pd.concat(sub_frames, axis=1)
         st.dataframe(df, use_container_width=True)
 
 
@@ -106,11 +120,15 @@ def compare_metrics_page():
     # --------------------------------------------------------
     # STEP 1: Check cache first
     # --------------------------------------------------------
+    common_metrics = None
     if cache_file.exists():
-        st.success(f"✅ Loaded cached common metrics for {category} from {cache_file.name}")
-        with open(cache_file, "r") as f:
-            common_metrics = json.load(f)
-    else:
+        try:
+            common_metrics = orjson.loads(cache_file.read_bytes())
+            st.success(f"✅ Loaded cached common metrics for {category} from {cache_file.name}")
+        except orjson.JSONDecodeError:
+            st.warning(f"⚠️ Cached file {cache_file.name} is not valid JSON — regenerating.")
+
+    if common_metrics is None:
         # --------------------------------------------------------
         # STEP 2: Generate via Gemini if cache not found
         # --------------------------------------------------------
@@ -120,20 +138,21 @@ def compare_metrics_page():
                 st.error("❌ Please enter your Google API key in the sidebar first.")
                 return
 
-            client = genai.Client(api_key=api_key)
+            from .clients import get_genai_client
+            client = get_genai_client(api_key)
 
             # Load and filter CSVs
             dataframes = []
             for fname in selected_files:
                 path = results_dir / fname
                 try:
-                    df = pd.read_csv(path)
-                    expected_cols = {"metric_name", "value", "unit", "year", "category", "source"}
-                    if not expected_cols.issubset(df.columns):
+                    by_category = _split_by_category(str(path), path.stat().st_mtime)
+                    if by_category is None:
                         st.warning(f"{fname} missing expected columns — skipping.")
                         continue
-                    df_filtered = df[df["category"].str.lower() == category.lower()]
-                    dataframes.append(df_filtered)
+                    df_filtered = by_category.get(category)
+                    if df_filtered is not None and not df_filtered.empty:
+                        dataframes.append(df_filtered)
                 except Exception as e:
                     st.warning(f"⚠️ Could not read {fname}: {e}")
 
@@ -142,9 +161,11 @@ def compare_metrics_page():
                 return
 
             # Prepare Gemini input
-            tables = [df.to_dict(orient="records") for df in dataframes]
+            payload = _tables_payload(dataframes)
             prompt = f"""
-You are an ESG data analyst. I will give you multiple sustainability metric tables (as JSON).
+You are an ESG data analyst. I will give you multiple sustainability metric tables in a compact column-oriented format.
+Each table starts with a "dataset_N columns: [...]" line listing its column names once, followed by one JSON array per row
+whose values are in that column order; tables are separated by a "---" line.
 
 Each dataset has the following columns:
 - "metric_name": the name of the metric (e.g., Scope 1 GHG emissions, renewable electricity use)
@@ -160,7 +181,7 @@ Your task:
    - Names do not have to match exactly; interpret semantically.
 2. For each group of common metrics, return a structured JSON object with:
    - "common_metric": a concise name summarizing the shared topic (e.g. "GHG Emissions (Scopes 1 & 2)")
-   - "dataset_1": an array of matching metric objects from the first dataset
+   - "dataset_1": an array of matching metric objects (keyed by the column names) from the first dataset
    - "dataset_2": an array of matching metric objects from the second dataset
    - etc. for all datasets.
 
@@ -170,7 +191,7 @@ Return **only** a valid JSON array, no explanations or text.
             with st.spinner("🤖 Analyzing and comparing data using Gemini..."):
                 response = client.models.generate_content(
                     model="gemini-2.5-flash",
-                    contents=[prompt, json.dumps(tables, indent=2)]
+                    contents=[prompt, payload]
                 )
 
             with st.expander("🧾 See Raw Gemini Output"):
@@ -180,12 +201,11 @@ Return **only** a valid JSON array, no explanations or text.
             metrics_text = extract_json(response.text)
 
             try:
-                common_metrics = json.loads(metrics_text)
-                # Cache result
-                with open(cache_file, "w") as f:
-                    json.dump(common_metrics, f, indent=2)
-                st.success(f"✅ Analysis complete and cached as {cache_file.name}")
-            except json.JSONDecodeError:
+                common_metrics = orjson.loads(metrics_text)
+                # Cache result without holding up the tables below
+                save_metrics_async(common_metrics, cache_file)
+                st.success(f"✅ Analysis complete; caching as {cache_file.name}")
+            except orjson.JSONDecodeError:
                 st.error("❌ Gemini output was not valid JSON.")
                 return
         else:
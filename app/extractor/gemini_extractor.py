@@ -1,78 +1,210 @@
 from google import genai
-import os, json
-from typing import List, Dict
-import re
+from google.genai import errors, types
+import os
+import orjson
+import ijson
+from typing import List, Dict, Literal, Optional
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from pydantic import BaseModel
 
-class MetricsExtractor:
-    def __init__(self, api_key: str = None):
-        if api_key is None:
-            api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise ValueError("Google API key not found. Please set GOOGLE_API_KEY.")
-        self.client = genai.Client(api_key=api_key)
+from .rate_limiter import TokenBucket
 
-    def extract_metrics(self, text_chunks: List[Dict[str, str]]) -> List[Dict]:
-        """
-        Extract ESG metrics from text chunks.
-        Each chunk is expected to be a dict with:
-          {
-            "page_number": int,
-            "text": str
-          }
-        """
-        base_prompt = """
+
+class Metric(BaseModel):
+    """Schema Gemini must follow for each extracted metric."""
+    metric_name: str
+    value: str
+    unit: str
+    year: Optional[int]
+    category: Literal["Environmental", "Social", "Governance"]
+    source_page: int
+
+
+class MetricsExtractor:
+    base_prompt = """
         You are an ESG data extraction assistant.
-        Extract sustainability metrics from the text and return a **valid JSON array**.
+        The input is a JSON array of pages, each with "page_number" and "text".
+        Extract sustainability metrics from the pages and return a single flat JSON array.
         Each entry must include:
           - metric_name
           - value
           - unit
           - year
           - category (Environmental, Social, Governance)
-        Do NOT include any explanations, markdown, or code fences. Return strictly JSON.
-
-        Text:
-        {text}
+          - source_page (copied from the "page_number" of the page the metric came from)
         """
 
-        all_metrics = []
+    generation_config = types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=list[Metric],
+    )
+
+    # Gemini quota: sustained requests per minute and how many may burst at once
+    requests_per_minute = 60
+    burst = 10
+    max_retries = 5
+    # Transient API errors worth retrying: rate limited, service unavailable
+    retry_codes = (429, 503)
+    initial_backoff = 2.0
+
+    # Rough budget for the page text sent in one request (~4 characters per token)
+    max_batch_pages = 6
+    max_batch_tokens = 200_000
+
+    def __init__(self, api_key: str = None, client: genai.Client = None, max_workers: int = 8,
+                 max_batch_pages: int = None, requests_per_minute: int = None):
+        if client is None:
+            if api_key is None:
+                api_key = os.getenv("GOOGLE_API_KEY")
+            if not api_key:
+                raise ValueError("Google API key not found. Please set GOOGLE_API_KEY.")
+            client = genai.Client(api_key=api_key)
+        self.client = client
+        self.max_workers = max_workers
+        if max_batch_pages is not None:
+            self.max_batch_pages = max_batch_pages
+        if requests_per_minute is not None:
+            self.requests_per_minute = requests_per_minute
+        # Caps the number of Gemini requests in flight at once
+        self._limiter = threading.Semaphore(max_workers)
+        # Paces request starts to the per-minute quota; a burst never exceeds one minute's quota
+        self._bucket = TokenBucket(rate=self.requests_per_minute / 60.0,
+                                   capacity=min(self.burst, self.requests_per_minute))
+
+    def _make_batches(self, text_chunks: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        """Group consecutive pages into batches that fit the page and token budgets."""
+        batches, current, current_tokens = [], [], 0
         for chunk in text_chunks:
-            page_number = chunk.get("page_number")
-            text = chunk.get("text", "")
+            tokens = len(chunk.get("text") or "") // 4
+            if current and (len(current) >= self.max_batch_pages
+                            or current_tokens + tokens > self.max_batch_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(chunk)
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _call_batch(self, batch: List[Dict[str, str]]) -> List[Dict]:
+        """Send a batch of pages to Gemini in one request and return its metrics.
 
-            response = self.client.models.generate_content(
+        Calls are paced by the shared token bucket; 429 and 503 responses
+        are retried with exponential backoff. If the batch still fails, a single
+        {"error", "pages", "source_page"} record is returned instead of raising.
+        """
+        delay = self.initial_backoff
+        try:
+            for attempt in range(self.max_retries + 1):
+                self._bucket.acquire()
+                try:
+                    return self._stream_batch(batch)
+                except errors.APIError as e:
+                    if e.code not in self.retry_codes or attempt == self.max_retries:
+                        raise
+                    print(f"⏳ Gemini returned {e.code}, retrying in {delay:.0f}s")
+                    time.sleep(delay)
+                    delay *= 2
+        except Exception as e:
+            # Keep the other batches' metrics; report this one as an error record
+            pages = [c.get("page_number") for c in batch]
+            print(f"❌ Error on pages {', '.join(map(str, pages))}: {e}")
+            return [{
+                "error": str(e),
+                "pages": pages,
+                "source_page": pages[0]
+            }]
+
+    def _stream_batch(self, batch: List[Dict[str, str]]) -> List[Dict]:
+        """Stream one Gemini response for a batch of pages.
+
+        Gemini is asked for schema-constrained JSON, so the streamed
+        response is a bare array whose entries are parsed as soon as they
+        are complete. If the stream breaks off, the entries parsed so far
+        are still returned.
+        """
+        pages = [{"page_number": c.get("page_number"), "text": c.get("text") or ""} for c in batch]
+        first_page = pages[0]["page_number"]
+        page_label = ", ".join(str(p["page_number"]) for p in pages)
+
+        buf = bytearray()
+        streamed = ijson.sendable_list()
+        parser = ijson.items_coro(streamed, "item", use_float=True)
+        metrics = []
+        finished = False
+
+        def collect():
+            # Move entries the parser has completed so far into metrics
+            for item in streamed:
+                if isinstance(item, dict):
+                    item.setdefault("source_page", first_page)
+                    metrics.append(item)
+            del streamed[:]
+
+        with self._limiter:
+            for event in self.client.models.generate_content_stream(
                 model="gemini-2.5-flash",
-                contents=base_prompt.format(text=text)
-            )
+                contents=[self.base_prompt, orjson.dumps(pages).decode()],
+                config=self.generation_config
+            ):
+                data = (event.text or "").encode()
+                # ijson treats b"" as end of input, so skip events without text
+                if not data:
+                    continue
+                buf += data
+                if parser is None:
+                    continue
+                try:
+                    parser.send(data)
+                except StopIteration:
+                    # The parser has already seen the end of the document
+                    finished = True
+                    parser = None
+                except ijson.JSONError:
+                    parser = None
+                collect()
 
-            print(f"🧾 Raw Gemini 2.5 flash response for page {page_number}:", response.text)
-            raw_text = response.text.strip()
+        raw_text = buf.decode().strip()
+        print(f"🧾 Raw Gemini 2.5 flash response for pages {page_label}:", raw_text)
+        if parser is not None:
             try:
-                parsed = json.loads(raw_text)
-                if isinstance(parsed, list):
-                    for item in parsed:
-                        if isinstance(item, dict):
-                            item["source_page"] = page_number
-                            all_metrics.append(item)
-                elif isinstance(parsed, dict):
-                    parsed["source_page"] = page_number
-                    all_metrics.append(parsed)
-            except json.JSONDecodeError:
-                match = re.search(r'(\[.*\]|\{.*\})', raw_text, re.DOTALL)
-                if match:
-                    parsed = json.loads(match.group())
-                    if isinstance(parsed, list):
-                        for item in parsed:
-                            if isinstance(item, dict):
-                                item["source_page"] = page_number
-                                all_metrics.append(item)
-                    elif isinstance(parsed, dict):
-                        parsed["source_page"] = page_number
-                        all_metrics.append(parsed)
-                else:
-                    all_metrics.append({
-                        "raw_output": raw_text,
-                        "source_page": page_number
-                    })
+                parser.close()
+                collect()
+                return metrics
+            except ijson.JSONError:
+                collect()
+        elif finished:
+            return metrics
+
+        # Truncated or otherwise unparseable stream: keep the entries that were
+        # complete before the break, plus the raw text for inspection
+        return metrics + [{
+            "raw_output": raw_text,
+            "source_page": first_page
+        }]
+
+    def extract_metrics(self, text_chunks: List[Dict[str, str]]) -> List[Dict]:
+        """
+        Extract ESG metrics from text chunks.
+        Each chunk is expected to be a dict with:
+          {
+            "page_number": int,
+            "text": str
+          }
+        Pages are grouped into batches, one Gemini request per batch, and
+        batches are sent concurrently; results keep the input order.
+        """
+        if not text_chunks:
+            return []
+
+        batches = self._make_batches(text_chunks)
+        workers = min(self.max_workers, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(self._call_batch, batch) for batch in batches]
+            all_metrics = []
+            for future in futures:
+                all_metrics.extend(future.result())
 
         return all_metrics
@@ -1,35 +1,126 @@
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import os
 import re
-import json
+import tempfile
+import threading
+import pandas as pd
+import orjson
+
+_JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(\[[\s\S]*\])\s*```", re.DOTALL)
+_JSON_CLOSERS = {'[': ']', '{': '}'}
+
+# os.umask can only be read by setting it; do that once at import, before any
+# background writer threads exist, rather than briefly changing it per write
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+_CLEAN_RE = re.compile(r'(\s+)|[^\w\s.,()\-]+')
+_NUM_RE = re.compile(r'-?\d+(\.\d+)?')
+_SNAKE_RE = re.compile(r'(?<!^)(?=[A-Z])')
+
+ESG_CATEGORY_DTYPE = pd.CategoricalDtype(["Environmental", "Social", "Governance"])
+
+def _clean_match(match: re.Match) -> str:
+    return ' ' if match.group(1) else ''
 
 def clean_text(text: str) -> str:
     """Clean and normalize extracted text."""
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
-    # Remove special characters
-    text = re.sub(r'[^\w\s.,()-]', '', text)
+    # Collapse whitespace runs and drop special characters in a single pass
+    return _CLEAN_RE.sub(_clean_match, text).strip()
+
+def extract_json(text: str) -> str:
+    """Extract JSON from Gemini output, even if wrapped in code fences."""
+    json_match = _JSON_FENCE_RE.search(text)
+    if json_match:
+        text = json_match.group(1)
     return text.strip()
 
+def find_json_span(text: str) -> Optional[str]:
+    """Return the first balanced JSON array/object in text, scanning it once.
+
+    Brackets inside JSON strings are ignored. Returns None if no opener is
+    found or it is never closed.
+    """
+    start = None
+    stack = []
+    in_string = False
+    escape = False
+
+    for i, ch in enumerate(text):
+        if start is None:
+            if ch in _JSON_CLOSERS:
+                start = i
+                stack.append(_JSON_CLOSERS[ch])
+            continue
+
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in _JSON_CLOSERS:
+            stack.append(_JSON_CLOSERS[ch])
+        elif ch in ']}':
+            if ch != stack.pop():
+                return None
+            if not stack:
+                return text[start:i + 1]
+
+    return None
+
+def to_esg_category(categories: pd.Series) -> pd.Series:
+    """Capitalize category labels into ESG_CATEGORY_DTYPE; unknown labels become NaN."""
+    return categories.astype("string").str.capitalize().astype(ESG_CATEGORY_DTYPE)
+
 def format_metrics(metrics: Dict[str, Any]) -> Dict[str, Any]:
     """Format and standardize extracted metrics."""
     formatted = {}
     
     for key, value in metrics.items():
         # Convert keys to snake_case
-        formatted_key = re.sub(r'(?<!^)(?=[A-Z])', '_', key).lower()
+        formatted_key = _SNAKE_RE.sub('_', key).lower()
         
         # Ensure numeric values are properly typed
-        if isinstance(value, str) and value.replace('.', '').isdigit():
-            value = float(value) if '.' in value else int(value)
+        if isinstance(value, str):
+            match = _NUM_RE.fullmatch(value)
+            if match:
+                value = float(value) if match.group(1) else int(value)
         
         formatted[formatted_key] = value
     
     return formatted
 
 def save_metrics(metrics: Dict[str, Any], output_path: str) -> None:
-    """Save extracted metrics to JSON file."""
+    """Save extracted metrics to JSON file.
+
+    Writes to a temp file in the same directory and renames it into place,
+    so readers never see a half-written file.
+    """
+    tmp_path = None
     try:
-        with open(output_path, 'w') as f:
-            json.dump(metrics, f, indent=2)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(metrics, option=orjson.OPT_INDENT_2))
+        # mkstemp creates the file as 0600; give it the mode open() would have
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, output_path)
     except Exception as e:
-        raise Exception(f"Error saving metrics: {str(e)}")
\ No newline at end of file
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise Exception(f"Error saving metrics: {str(e)}")
+
+def save_metrics_async(metrics: Any, output_path: str) -> threading.Thread:
+    """Save metrics to a JSON file on a background thread so the caller can keep rendering."""
+    def target():
+        try:
+            save_metrics(metrics, output_path)
+        except Exception as e:
+            print(f"❌ {e} ({output_path})")
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
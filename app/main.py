@@ -3,14 +3,8 @@ import os
 import json
 from pathlib import Path
 import pandas as pd
-import time
-import pdfplumber
-from google import genai
-import re
 
-from extractor.pdf_splitter import split_pdf  # your PDF splitting helper
 from extractor.compare_metrics import compare_metrics_page
-from extractor.gemini_extractor import MetricsExtractor  # your custom extractor
 
 # ------------------------------------------------------------
 # Page config
@@ -23,7 +17,8 @@ st.set_page_config(page_title="Sustainability Metrics Extractor", page_icon="
 with st.sidebar:
     st.header("Configuration")
     api_key = st.text_input("Enter Google API Key", type="password")
-    pages_per_part = st.number_input("Pages per part", min_value=2, max_value=20, value=5)
+    pages_per_part = st.number_input("Pages per Gemini request", min_value=2, max_value=20, value=5)
+    requests_per_minute = st.number_input("Gemini requests per minute", min_value=1, max_value=2000, value=60)
     if api_key:
         os.environ["GOOGLE_API_KEY"] = api_key
 
@@ -39,22 +34,13 @@ if page == "Compare ESG Metrics":
     compare_metrics_page()  # Call your compare page
     st.stop()
 
-# ------------------------------------------------------------
-# JSON cleanup helper
-# ------------------------------------------------------------
-def extract_json(text):
-    json_match = re.search(r"```(?:json)?\s*(\[\s*{.*}\s*\])\s*```", text, re.DOTALL)
-    if json_match:
-        text = json_match.group(1)
-    return text.strip()
-
 # ------------------------------------------------------------
 # Main App
 # ------------------------------------------------------------
 st.title("🌱 Sustainability Report Metrics Extractor")
 st.markdown("""
 Upload sustainability reports in **PDF format** to extract key ESG metrics using AI.
-Large PDFs will be **split automatically** into smaller chunks to avoid API limits.
+Pages are sent to Gemini in **small batches** to stay within API limits.
 """)
 
 uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
@@ -66,9 +52,7 @@ if uploaded_file and not api_key:
 if uploaded_file:
     file_name = uploaded_file.name
     results_dir = Path("data/extracted_results")
-    temp_dir = Path("data/pdf_parts")
     results_dir.mkdir(parents=True, exist_ok=True)
-    temp_dir.mkdir(parents=True, exist_ok=True)
     result_csv = results_dir / f"{Path(file_name).stem}.csv"
 
     # -------------------------
@@ -81,76 +65,73 @@ if uploaded_file:
         st.dataframe(df)
         st.stop()
 
-    # Save uploaded file temporarily
-    temp_pdf_path = temp_dir / file_name
-    with open(temp_pdf_path, "wb") as f:
-        f.write(uploaded_file.getvalue())
+    # PDF, Gemini and Arrow modules are only needed from here on
+    import fitz  # PyMuPDF
+    import pyarrow as pa
+    import pyarrow.csv as pcsv
+    from extractor.clients import get_genai_client
+    from extractor.gemini_extractor import MetricsExtractor  # your custom extractor
+    from extractor.utils import to_esg_category
 
     # -------------------------
-    # Split the PDF into parts
+    # Read text per page straight from the upload
     # -------------------------
-    st.info("✂️ Splitting PDF into smaller parts...")
-    pdf_parts = split_pdf(temp_pdf_path, temp_dir, pages_per_part=pages_per_part)
-    st.success(f"✅ Split into {len(pdf_parts)} parts.")
+    st.info("📄 Reading PDF text...")
+    text_chunks = []
+    try:
+        with fitz.open(stream=uploaded_file.getvalue(), filetype="pdf") as doc:
+            for i, pdf_page in enumerate(doc, start=1):
+                text_chunks.append({
+                    "page_number": i,
+                    "text": pdf_page.get_text("text")
+                })
+    except Exception as e:
+        st.error(f"❌ Could not read PDF: {str(e)}")
+        st.stop()
+    st.success(f"✅ Read {len(text_chunks)} pages.")
 
     # -------------------------
-    # Initialize MetricsExtractor
+    # Initialize MetricsExtractor (pages_per_part pages per Gemini request)
     # -------------------------
-    extractor = MetricsExtractor(api_key=os.environ.get("GOOGLE_API_KEY"))
+    client = get_genai_client(os.environ.get("GOOGLE_API_KEY"))
+    extractor = MetricsExtractor(client=client, max_batch_pages=pages_per_part,
+                                 requests_per_minute=requests_per_minute)
     all_metrics = []
 
+    st.info("🔍 Extracting metrics from PDF pages...")
+
     # -------------------------
-    # Process each PDF part
+    # Extract metrics (pages are sent to Gemini concurrently)
     # -------------------------
-    st.info("🔍 Extracting metrics from PDF parts...")
-
-    page_offset = 0  # keep track of where the chunk starts in the full PDF
-
-    for idx, part in enumerate(pdf_parts, start=1):
-        st.write(f"📄 Processing part {idx}/{len(pdf_parts)}: {Path(part).name}")
-        try:
-            # Extract text per page
-            text_chunks = []
-            with pdfplumber.open(part) as pdf:
-                for i, page in enumerate(pdf.pages, start=1):
-                    text_chunks.append({
-                        "page_number": page_offset + i,  # absolute page number
-                        "text": page.extract_text()
-                    })
-
-            # Extract metrics
-            metrics = extractor.extract_metrics(text_chunks)
-
-            # Add source info & normalize categories
-            for m in metrics:
-                m["source"] = f"{file_name} - page {m.get('source_page', 'unknown')}"
-                category = m.get("category", "").capitalize()
-                if category not in ["Environmental", "Social", "Governance"]:
-                    m["category"] = "Environmental"
-            all_metrics.extend(metrics)
-
-            # Update offset for next chunk
-            page_offset += len(pdf.pages)
-
-            # Cooldown to prevent rate limit
-            time.sleep(5)
-
-        except Exception as e:
-            st.error(f"❌ Error on part {idx}: {str(e)}")
-            time.sleep(5)
-            continue
+    try:
+        metrics = extractor.extract_metrics(text_chunks)
+
+        # Add source info; failed batches are reported and skipped
+        for m in metrics:
+            if "error" in m:
+                pages = ", ".join(map(str, m.get("pages", [])))
+                st.error(f"❌ Error on pages {pages}: {m['error']}")
+                continue
+            m["source"] = f"{file_name} - page {m.get('source_page', 'unknown')}"
+            all_metrics.append(m)
+
+    except Exception as e:
+        st.error(f"❌ Error extracting metrics: {str(e)}")
 
     # -------------------------
     # Combine and save results
     # -------------------------
-    if all_metrics:
-        df = pd.DataFrame(all_metrics)
-        # Reorder columns
-        columns_order = ["metric_name", "value", "unit", "year", "category", "source"]
-        df = df[columns_order]
-        df.to_csv(result_csv, index=False)
+    columns_order = ["metric_name", "value", "unit", "year", "category", "source"]
+    df = pd.DataFrame(all_metrics).reindex(columns=columns_order)
+    # Batches that only produced raw_output records have no metric_name; don't cache those
+    if df["metric_name"].notna().any():
+        # Normalize categories; anything unrecognised defaults to Environmental
+        df["category"] = to_esg_category(df["category"]).fillna("Environmental")
+        # Write the output columns with Arrow's CSV writer
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pcsv.write_csv(table, result_csv)
         st.subheader("📊 Extracted ESG Metrics")
-        st.dataframe(df)
+        st.dataframe(table)
         st.success(f"✅ Combined results saved to {result_csv}")
     else:
         st.warning("⚠️ No metrics were extracted from any part of the PDF.")
@@ -1,14 +1,16 @@
 import streamlit as st
 import os
-import json
+import orjson
 from datetime import datetime
 from pathlib import Path
 import pandas as pd
 import re
 
-from extractor import PDFParser, MetricsExtractor
+from extractor.utils import find_json_span, save_metrics_async
 from extractor.compare_metrics import compare_metrics_page
 
+_CODE_FENCE_RE = re.compile(r"^```json|```$", re.IGNORECASE | re.MULTILINE)
+
 
 # ------------------------------------------------------------
 # Page configuration
@@ -41,16 +43,16 @@ def parse_gemini_output(output):
         return {}
 
     # Remove code fences like ```json ... ```
-    cleaned = re.sub(r"^```json|```$", "", output.strip(), flags=re.IGNORECASE | re.MULTILINE).strip()
+    cleaned = _CODE_FENCE_RE.sub("", output.strip()).strip()
 
     # Extract JSON structure (list or dict)
-    match = re.search(r"(\[.*\]|\{.*\})", cleaned, re.DOTALL)
-    if not match:
+    span = find_json_span(cleaned)
+    if span is None:
         return {}
 
     try:
-        return json.loads(match.group())
-    except json.JSONDecodeError:
+        return orjson.loads(span)
+    except orjson.JSONDecodeError:
         st.warning("⚠️ Gemini output is not valid JSON.")
         return {}
     
@@ -130,8 +132,8 @@ def main():
 
                 # Step 3: Parse JSON
                 try:
-                    metrics_list = json.loads(metrics)
-                except json.JSONDecodeError:
+                    metrics_list = orjson.loads(metrics)
+                except orjson.JSONDecodeError:
                     metrics_list = []
                     print("❌ Could not decode JSON")
 
@@ -173,13 +175,13 @@ def main():
 
             # Extract metrics using Gemini
                 with st.spinner("Extracting metrics via Gemini..."):
+                    from extractor import PDFParser, MetricsExtractor
                     pdf_parser = PDFParser()
                     metrics_extractor = MetricsExtractor()
                     metrics = metrics_extractor.extract_metrics(text_chunks)
                 
-                with open(json_cache_path, "w") as f:
-                    json.dump(metrics, f, indent=2)
-                st.success("✅ Saved Gemini output to cache.")
+                save_metrics_async(metrics, json_cache_path)
+                st.success("✅ Saving Gemini output to cache.")
 
             # Parse output
                 st.write("Here is the metrics")
@@ -190,7 +192,7 @@ def main():
                 # Step 3: Parse JSON
                 try:
                     metrics_list = metrics
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     metrics_list = []
                     print("❌ Could not decode JSON")
 